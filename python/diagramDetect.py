@@ -1,9 +1,21 @@
+import hashlib
+import json
 import os
+import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
 
+from profiling import profile_section
+
+# >1 runs proposers and candidate analysis on a thread pool (OpenCV releases
+# the GIL); results are merged in the serial order, so output is identical.
+DIAGRAM_THREADS = int(os.getenv("DIAGRAM_THREADS", "1"))
+
+EDGE_DILATIONS = [((7, 7), 2), ((11, 11), 1), ((15, 9), 1)]
+
 
 def clip_box(x, y, w, h, width, height):
     x = max(0, min(int(x), width - 1))
@@ -98,10 +110,204 @@ def preprocess(img):
     return ink, edges
 
 
-def propose_from_edges(edges, width, height):
+def page_fingerprint(ink, grid=16):
+    # Downsampled ink-mask hash: one bit per grid cell that holds more than a
+    # fixed share of ink. Only used to pick candidates for verify_page_mask;
+    # a fingerprint match alone never reuses anything.
+    small = cv2.resize(ink, (grid, grid), interpolation=cv2.INTER_AREA)
+    bits = (small > 0.02 * 255).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return format(value, "0{}x".format(grid * grid // 4))
+
+
+def fingerprint_distance(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def page_mask(ink, size=256):
+    # Binary ink mask at a fixed resolution, stored with each index entry so a
+    # candidate match can be checked pixel by pixel.
+    small = cv2.resize(ink, (size, size), interpolation=cv2.INTER_AREA)
+    return np.where(small > 0.05 * 255, 255, 0).astype(np.uint8)
+
+
+def mask_difference(a, b, tiles=8):
+    """Compare two page masks; returns ``(ratio, worst_tile_pixels)``.
+
+    A pixel mismatches when it is ink in one mask with no ink within one pixel
+    in the other (the 3x3 tolerance absorbs small scan shifts). ``ratio`` is the
+    mismatch share of all ink; ``worst_tile_pixels`` is the largest absolute
+    mismatch in any of the ``tiles`` x ``tiles`` tiles, which catches a small
+    local difference such as a handwritten name on an otherwise shared page.
+    """
+    kernel = np.ones((3, 3), np.uint8)
+    mismatch = ((a > 0) & (cv2.dilate(b, kernel) == 0)) | ((b > 0) & (cv2.dilate(a, kernel) == 0))
+
+    total = np.count_nonzero(a) + np.count_nonzero(b)
+    ratio = np.count_nonzero(mismatch) / float(total) if total else 0.0
+
+    th, tw = mismatch.shape[0] // tiles, mismatch.shape[1] // tiles
+    per_tile = mismatch[: th * tiles, : tw * tiles].reshape(tiles, th, tiles, tw).sum(axis=(1, 3))
+    return ratio, int(per_tile.max())
+
+
+def mask_digest(mask):
+    return hashlib.sha1(mask.tobytes()).hexdigest()[:16]
+
+
+# Index layout under PAGE_INDEX_DIR:
+#   entries/<id>/entry.json, mask.png, diagram_*.png
+#   bands/<i>/<hex>/<id>   empty marker per fingerprint band
+# An entry id is "<fingerprint>-<mask digest>", so pages that share a
+# fingerprint still get separate entries. The 64-hex fingerprint is split into
+# FINGERPRINT_BANDS bands; two pages within FINGERPRINT_BANDS - 1 bits share at
+# least one band exactly, so a lookup only lists the matching band buckets.
+FINGERPRINT_BANDS = 8
+
+
+def fingerprint_bands(fingerprint):
+    width = len(fingerprint) // FINGERPRINT_BANDS
+    return [fingerprint[i * width : (i + 1) * width] for i in range(FINGERPRINT_BANDS)]
+
+
+def entry_dir_for(index_dir, entry_id):
+    return os.path.join(index_dir, "entries", entry_id)
+
+
+def verify_page_mask(index_dir, entry_id, mask, max_pixel_diff, max_tile_pixels):
+    stored = cv2.imread(
+        os.path.join(entry_dir_for(index_dir, entry_id), "mask.png"), cv2.IMREAD_GRAYSCALE
+    )
+    if stored is None or stored.shape != mask.shape:
+        return False
+    ratio, worst_tile = mask_difference(stored, mask)
+    return ratio <= max_pixel_diff and worst_tile <= max_tile_pixels
+
+
+def find_indexed_page(index_dir, fingerprint, mask, max_distance, max_pixel_diff, max_tile_pixels):
+    max_distance = min(max_distance, FINGERPRINT_BANDS - 1)
+
+    candidates = set()
+    for i, band in enumerate(fingerprint_bands(fingerprint)):
+        bucket = os.path.join(index_dir, "bands", str(i), band)
+        try:
+            candidates.update(os.listdir(bucket))
+        except OSError:
+            continue
+
+    ranked = []
+    for entry_id in candidates:
+        candidate_fp = entry_id.split("-", 1)[0]
+        if len(candidate_fp) == len(fingerprint):
+            ranked.append((fingerprint_distance(candidate_fp, fingerprint), entry_id))
+
+    for distance, entry_id in sorted(ranked):
+        if distance > max_distance:
+            break
+        if not verify_page_mask(index_dir, entry_id, mask, max_pixel_diff, max_tile_pixels):
+            continue
+        entry_path = os.path.join(entry_dir_for(index_dir, entry_id), "entry.json")
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+            # mtime doubles as last-use time for eviction.
+            os.utime(entry_path)
+        except (OSError, ValueError):
+            continue
+        entry["entry"] = entry_path
+        return entry
+
+    return None
+
+
+def remove_indexed_page(index_dir, entry_id):
+    fingerprint = entry_id.split("-", 1)[0]
+    for i, band in enumerate(fingerprint_bands(fingerprint)):
+        try:
+            os.remove(os.path.join(index_dir, "bands", str(i), band, entry_id))
+        except OSError:
+            pass
+    shutil.rmtree(entry_dir_for(index_dir, entry_id), ignore_errors=True)
+
+
+def evict_indexed_pages(index_dir, max_entries):
+    entries_root = os.path.join(index_dir, "entries")
+    try:
+        names = os.listdir(entries_root)
+    except OSError:
+        return
+    if len(names) <= max_entries:
+        return
+
+    last_used = []
+    for name in names:
+        try:
+            mtime = os.path.getmtime(os.path.join(entries_root, name, "entry.json"))
+        except OSError:
+            mtime = 0.0
+        last_used.append((mtime, name))
+
+    for _, name in sorted(last_used)[: len(names) - max_entries]:
+        remove_indexed_page(index_dir, name)
+
+
+def record_indexed_page(index_dir, fingerprint, mask, diagram_paths, max_entries):
+    entry_id = f"{fingerprint}-{mask_digest(mask)}"
+    entry_dir = entry_dir_for(index_dir, entry_id)
+    entry_path = os.path.join(entry_dir, "entry.json")
+
+    # Same id means a pixel-identical mask; keep any text already recorded.
+    text = None
+    try:
+        with open(entry_path) as f:
+            text = json.load(f).get("text")
+    except (OSError, ValueError):
+        pass
+
+    # Build the entry in a fresh directory so no stale crops survive.
+    shutil.rmtree(entry_dir, ignore_errors=True)
+    os.makedirs(entry_dir, exist_ok=True)
+    cv2.imwrite(os.path.join(entry_dir, "mask.png"), mask)
+
+    diagrams = []
+    for path in diagram_paths:
+        cached = os.path.join(entry_dir, os.path.basename(path))
+        shutil.copyfile(path, cached)
+        diagrams.append(cached)
+
+    entry = {"id": entry_id, "fingerprint": fingerprint, "diagrams": diagrams, "text": text}
+    tmp_path = entry_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, entry_path)
+
+    for i, band in enumerate(fingerprint_bands(fingerprint)):
+        bucket = os.path.join(index_dir, "bands", str(i), band)
+        os.makedirs(bucket, exist_ok=True)
+        open(os.path.join(bucket, entry_id), "a").close()
+
+    evict_indexed_pages(index_dir, max_entries)
+    entry["entry"] = entry_path
+    return entry
+
+
+def restore_indexed_diagrams(entry, output_dir):
+    written = []
+    for idx, cached in enumerate(entry.get("diagrams", [])):
+        out_path = os.path.join(output_dir, f"diagram_{idx}.png")
+        try:
+            shutil.copyfile(cached, out_path)
+        except OSError:
+            return None
+        written.append(out_path)
+    return written
+
+
+def propose_from_edges(edges, width, height, params=EDGE_DILATIONS):
     min_area = 0.0025 * width * height
     proposals = []
-    params = [((7, 7), 2), ((11, 11), 1), ((15, 9), 1)]
     for kernel_size, iters in params:
         kernel = cv2.getStructuringElement(cv2.MORPH_RECT, kernel_size)
         mask = cv2.dilate(edges, kernel, iterations=iters)
@@ -110,15 +316,20 @@ def propose_from_edges(edges, width, height):
     return proposals
 
 
-def propose_from_ink_groups(ink, width, height):
-    min_area = 0.004 * width * height
-    proposals = []
-
-    kernels = [
+def ink_group_kernels(width, height):
+    return [
         (max(17, int(0.02 * width)), max(13, int(0.015 * height))),
         (max(27, int(0.03 * width)), max(17, int(0.02 * height))),
     ]
 
+
+def propose_from_ink_groups(ink, width, height, kernels=None):
+    min_area = 0.004 * width * height
+    proposals = []
+
+    if kernels is None:
+        kernels = ink_group_kernels(width, height)
+
     for kx, ky in kernels:
         kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kx, ky))
         mask = cv2.morphologyEx(ink, cv2.MORPH_CLOSE, kernel)
@@ -439,33 +650,109 @@ def refine_false_positives(candidates, width, height):
     return refined
 
 
-def extract_diagrams(image_path, output_dir):
+def extract_diagrams(
+    image_path,
+    output_dir,
+    index_dir=None,
+    max_distance=4,
+    max_pixel_diff=0.01,
+    max_tile_pixels=6,
+    max_entries=2000,
+):
+    """Write diagram crops for one page and return their paths.
+
+    With ``index_dir`` set, returns ``(paths, page_entry)`` instead. An indexed
+    page is reused (crops and any OCR text recorded against it) only if its
+    fingerprint lies within ``max_distance`` bits *and* its stored ink mask
+    differs from this page's in at most ``max_pixel_diff`` of ink pixels and by
+    no more than ``max_tile_pixels`` mask pixels within any one tile. The
+    index keeps at most ``max_entries`` pages, evicting the least recently used.
+    """
     os.makedirs(output_dir, exist_ok=True)
 
     img = cv2.imread(image_path)
     if img is None:
-        return []
+        return ([], None) if index_dir else []
 
     height, width = img.shape[:2]
     ink, edges = preprocess(img)
 
-    edge_candidates = propose_from_edges(edges, width, height)
-    ink_candidates = propose_from_ink_groups(ink, width, height)
-    layout_candidates = propose_from_layout_bands(ink, width, height)
-    merged_layout = merge_layout_bands(layout_candidates, width, height)
+    if index_dir:
+        fingerprint = page_fingerprint(ink)
+        mask = page_mask(ink)
+        entry = find_indexed_page(
+            index_dir, fingerprint, mask, max_distance, max_pixel_diff, max_tile_pixels
+        )
+        if entry is not None:
+            written = restore_indexed_diagrams(entry, output_dir)
+            if written is not None:
+                return written, dict(entry, match=True)
+
+        written = detect_diagrams(img, ink, edges, output_dir)
+        entry = record_indexed_page(index_dir, fingerprint, mask, written, max_entries)
+        return written, dict(entry, match=False)
+
+    return detect_diagrams(img, ink, edges, output_dir)
+
+
+def propose_parallel(executor, ink, edges, width, height):
+    # One task per dilation / close kernel; futures are read back in submission
+    # order so the proposal list matches the serial path exactly.
+    edge_futures = [
+        executor.submit(propose_from_edges, edges, width, height, [param])
+        for param in EDGE_DILATIONS
+    ]
+    ink_futures = [
+        executor.submit(propose_from_ink_groups, ink, width, height, [kernel])
+        for kernel in ink_group_kernels(width, height)
+    ]
+    layout_future = executor.submit(propose_from_layout_bands, ink, width, height)
 
-    proposals = edge_candidates + ink_candidates + layout_candidates + merged_layout
-    proposals = dedupe_candidates(proposals)
+    edge_candidates = [item for f in edge_futures for item in f.result()]
+    ink_candidates = [item for f in ink_futures for item in f.result()]
+    return edge_candidates, ink_candidates, layout_future.result()
+
+
+def detect_diagrams(img, ink, edges, output_dir, threads=None):
+    height, width = img.shape[:2]
+    threads = DIAGRAM_THREADS if threads is None else threads
+    executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+
+    try:
+        if executor is not None:
+            edge_candidates, ink_candidates, layout_candidates = propose_parallel(
+                executor, ink, edges, width, height
+            )
+        else:
+            edge_candidates = propose_from_edges(edges, width, height)
+            ink_candidates = propose_from_ink_groups(ink, width, height)
+            layout_candidates = propose_from_layout_bands(ink, width, height)
+        merged_layout = merge_layout_bands(layout_candidates, width, height)
+
+        proposals = edge_candidates + ink_candidates + layout_candidates + merged_layout
+        proposals = dedupe_candidates(proposals)
+        proposals = [
+            item
+            for item in proposals
+            if (item["box"][2] * item["box"][3]) / float(width * height) <= 0.88
+        ]
+
+        boxes = [item["box"] for item in proposals]
+        if executor is not None:
+            features_list = list(
+                executor.map(lambda box: analyze_box(box, ink, width, height), boxes)
+            )
+        else:
+            features_list = [analyze_box(box, ink, width, height) for box in boxes]
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
     scored = []
-    for item in proposals:
-        box = item["box"]
-        area_ratio = (box[2] * box[3]) / float(width * height)
-        if area_ratio > 0.88:
-            continue
-        features = analyze_box(box, ink, width, height)
+    for item, features in zip(proposals, features_list):
         if not features:
             continue
+        box = item["box"]
         score = score_candidate(item["weight"], features, box, width, height)
         scored.append({"box": box, "score": score})
 
@@ -494,7 +781,39 @@ def main():
 
     image_path = sys.argv[1]
     output_dir = sys.argv[2]
-    files = extract_diagrams(image_path, output_dir)
+
+    # --page-index <dir>: look the page up in a shared fingerprint index and
+    # print one JSON document instead of bare paths.
+    if len(sys.argv) > 4 and sys.argv[3] == "--page-index":
+        max_distance = int(os.getenv("PAGE_INDEX_MAX_DISTANCE", "4"))
+        max_pixel_diff = float(os.getenv("PAGE_INDEX_MAX_PIXEL_DIFF", "0.01"))
+        max_tile_pixels = int(os.getenv("PAGE_INDEX_MAX_TILE_PIXELS", "6"))
+        max_entries = int(os.getenv("PAGE_INDEX_MAX_ENTRIES", "2000"))
+        with profile_section("diagramDetect", meta={"image": image_path}) as meta:
+            files, entry = extract_diagrams(
+                image_path,
+                output_dir,
+                index_dir=sys.argv[4],
+                max_distance=max_distance,
+                max_pixel_diff=max_pixel_diff,
+                max_tile_pixels=max_tile_pixels,
+                max_entries=max_entries,
+            )
+            meta["diagrams"] = len(files)
+            meta["index_match"] = bool(entry and entry["match"])
+        print(json.dumps({
+            "diagrams": files,
+            "fingerprint": entry["fingerprint"] if entry else None,
+            "entry": entry["entry"] if entry else None,
+            "id": entry.get("id") if entry else None,
+            "match": bool(entry and entry["match"]),
+            "text": entry.get("text") if entry else None,
+        }))
+        return
+
+    with profile_section("diagramDetect", meta={"image": image_path}) as meta:
+        files = extract_diagrams(image_path, output_dir)
+        meta["diagrams"] = len(files)
     for file_path in files:
         print(file_path)
 
@@ -5,101 +5,141 @@ import os
 import json
 import numpy as np
 
-image_path = sys.argv[1]
-output_dir = sys.argv[2]
-output_base64 = len(sys.argv) > 3 and sys.argv[3] == "--base64"
-
-os.makedirs(output_dir, exist_ok=True)
-
-img = cv2.imread(image_path)
-if img is None:
-    sys.exit(0)
-
-orig_h, orig_w = img.shape[:2]
-
-gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-gray = cv2.resize(gray, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
-img = cv2.resize(img, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
-
-gray = cv2.bilateralFilter(gray, 5, 50, 50)
-
-thresh = cv2.adaptiveThreshold(
-    gray, 255,
-    cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-    cv2.THRESH_BINARY_INV,
-    31, 9
-)
-
-proj = cv2.reduce(thresh, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).flatten()
-proj = cv2.blur(proj.reshape(-1, 1), (1, 25)).flatten()
-
-line_bounds = []
-in_line = False
-start = 0
-threshold = max(proj) * 0.1
-
-for i, val in enumerate(proj):
-    if val > threshold and not in_line:
-        in_line = True
-        start = i
-    elif val <= threshold and in_line:
-        end = i
+from profiling import profile_section
+
+
+def find_line_bounds(thresh):
+    proj = cv2.reduce(thresh, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).flatten()
+    proj = cv2.blur(proj.reshape(-1, 1), (1, 25)).flatten()
+
+    line_bounds = []
+    in_line = False
+    start = 0
+    threshold = max(proj) * 0.1
+
+    for i, val in enumerate(proj):
+        if val > threshold and not in_line:
+            in_line = True
+            start = i
+        elif val <= threshold and in_line:
+            end = i
+            if end - start > 12:
+                line_bounds.append((start, end))
+            in_line = False
+
+    if in_line:
+        end = len(proj) - 1
         if end - start > 12:
             line_bounds.append((start, end))
-        in_line = False
 
-if in_line:
-    end = len(proj) - 1
-    if end - start > 12:
-        line_bounds.append((start, end))
+    return line_bounds
 
-grouped_bounds = list(line_bounds)
 
-count = 0
-pad = 20
+def segment_lines(img):
+    """Yield ``(line_img, box)`` for each text line, top to bottom.
 
-text_boxes = []
+    Boxes are in original page coordinates; crops are taken from the 2x
+    upscaled page.
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
-images_b64 = []
+    gray = cv2.resize(gray, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+    img = cv2.resize(img, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
 
-for (y1, y2) in grouped_bounds:
-    y1 = max(0, y1 - pad)
-    y2 = min(img.shape[0], y2 + pad)
+    gray = cv2.bilateralFilter(gray, 5, 50, 50)
 
-    line_thresh = thresh[y1:y2, :]
-    cols = cv2.reduce(line_thresh, 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S).flatten()
-    xs = [i for i, v in enumerate(cols) if v > 0]
-    if not xs:
-        continue
+    thresh = cv2.adaptiveThreshold(
+        gray, 255,
+        cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+        cv2.THRESH_BINARY_INV,
+        31, 9
+    )
 
-    x1 = max(0, min(xs) - pad)
-    x2 = min(img.shape[1], max(xs) + pad)
+    grouped_bounds = find_line_bounds(thresh)
 
-    line_img = img[y1:y2, x1:x2]
+    pad = 20
+    scale = 2
 
-    if output_base64:
-        ok, encoded = cv2.imencode(".png", line_img)
-        if ok:
-            images_b64.append(base64.b64encode(encoded).decode("ascii"))
-    else:
+    for (y1, y2) in grouped_bounds:
+        y1 = max(0, y1 - pad)
+        y2 = min(img.shape[0], y2 + pad)
+
+        line_thresh = thresh[y1:y2, :]
+        cols = cv2.reduce(line_thresh, 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S).flatten()
+        xs = np.flatnonzero(cols)
+        if not xs.size:
+            continue
+
+        x1 = max(0, int(xs[0]) - pad)
+        x2 = min(img.shape[1], int(xs[-1]) + pad)
+
+        box = {
+            "x": int(x1 / scale),
+            "y": int(y1 / scale),
+            "w": int((x2 - x1) / scale),
+            "h": int((y2 - y1) / scale)
+        }
+        yield img[y1:y2, x1:x2], box
+
+
+def encode_b64(line_img):
+    ok, encoded = cv2.imencode(".png", line_img)
+    if not ok:
+        return None
+    return base64.b64encode(encoded).decode("ascii")
+
+
+def main():
+    image_path = sys.argv[1]
+    output_dir = sys.argv[2]
+    mode = sys.argv[3] if len(sys.argv) > 3 else None
+
+    with profile_section("lineSegment", meta={"image": image_path}) as meta:
+        meta["lines"] = run(image_path, output_dir, mode)
+
+
+def run(image_path, output_dir, mode):
+    """Segment one page and write it out in ``mode``; returns the line count."""
+    os.makedirs(output_dir, exist_ok=True)
+
+    img = cv2.imread(image_path)
+    if img is None:
+        return 0
+
+    if mode == "--ndjson":
+        # One record per line, flushed as soon as it is cut, so the caller can
+        # start OCR before the page is finished.
+        count = 0
+        for index, (line_img, box) in enumerate(segment_lines(img)):
+            image = encode_b64(line_img)
+            if image is None:
+                continue
+            sys.stdout.write(json.dumps({"index": index, "box": box, "image": image}) + "\n")
+            sys.stdout.flush()
+            count += 1
+        return count
+
+    if mode == "--base64":
+        images_b64 = []
+        for line_img, _ in segment_lines(img):
+            image = encode_b64(line_img)
+            if image is not None:
+                images_b64.append(image)
+        print(json.dumps({"images": images_b64}))
+        return len(images_b64)
+
+    text_boxes = []
+    for count, (line_img, box) in enumerate(segment_lines(img)):
         out_path = os.path.join(output_dir, f"line_{count}.png")
         cv2.imwrite(out_path, line_img)
         print(out_path)
+        text_boxes.append(box)
 
-    scale = 2
-    text_boxes.append({
-        "x": int(x1 / scale),
-        "y": int(y1 / scale),
-        "w": int((x2 - x1) / scale),
-        "h": int((y2 - y1) / scale)
-    })
-
-    count += 1
-
-if output_base64:
-    print(json.dumps({"images": images_b64}))
-else:
     json_path = os.path.join(output_dir, "text_boxes.json")
     with open(json_path, "w") as f:
         json.dump(text_boxes, f, indent=2)
+    return len(text_boxes)
+
+
+if __name__ == "__main__":
+    main()
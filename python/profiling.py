@@ -0,0 +1,201 @@
+"""Opt-in per-request / per-page profiling.
+
+Set PROFILE_DIR to enable, or pass ``force=True`` (the TrOCR server does this
+for requests carrying an ``X-Profile: 1`` header). Each profiled section writes
+into PROFILE_DIR (default ``profiles``):
+
+    <label>-<timestamp>-<pid>-<seq>.collapsed    sampled stacks, one "a;b;c count"
+                                                 per line, readable by
+                                                 flamegraph.pl / speedscope
+    <label>-<timestamp>-<pid>-<seq>.prof         cProfile stats (PROFILE_MODE=cprofile)
+    <label>-<timestamp>-<pid>-<seq>.tracemalloc  top allocation sites (PROFILE_TRACEMALLOC=1)
+    <label>-<timestamp>-<pid>-<seq>.json         wall time plus caller-supplied metadata
+
+<seq> is a per-process counter, so sections started within the same second
+never overwrite each other.
+
+Other knobs:
+    PROFILE_SAMPLE_RATE  fraction of sections to profile when not forced (1.0)
+    PROFILE_INTERVAL_MS  stack sampling interval (5)
+    PROFILE_MIN_MS       discard output for sections faster than this (0)
+"""
+
+import cProfile
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "")
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sample")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "1.0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MIN_MS = float(os.getenv("PROFILE_MIN_MS", "0"))
+PROFILE_TRACEMALLOC = os.getenv("PROFILE_TRACEMALLOC", "0") == "1"
+
+_section_ids = itertools.count()
+_cprofile_warned = False
+
+# tracemalloc is process-wide; overlapping sections (e.g. concurrent server
+# requests) share one tracing session that stops when the last one exits.
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+
+def _acquire_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracemalloc_users += 1
+
+
+def _release_tracemalloc():
+    """Snapshot the shared session, then stop it if this was the last user."""
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        try:
+            return tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        finally:
+            _tracemalloc_users -= 1
+            if _tracemalloc_users == 0:
+                tracemalloc.stop()
+
+
+class StackSampler:
+    """Samples the given threads' stacks on a background thread."""
+
+    def __init__(self, thread_ids, interval):
+        self.thread_ids = [tid for tid in thread_ids if tid is not None]
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id in self.thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                names.append(thread_names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(names))] += 1
+
+    def write_collapsed(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def write_tracemalloc(snapshot, path, limit=25):
+    with open(path, "w") as f:
+        for stat in snapshot.statistics("lineno")[:limit]:
+            f.write(f"{stat}\n")
+
+
+@contextmanager
+def profile_section(label, force=False, meta=None, threads=None):
+    """Profile the enclosed block if enabled; yields a dict for extra metadata.
+
+    ``threads`` lists the thread idents to sample (default: the caller's), e.g.
+    to include a worker thread that does the real work on the caller's behalf.
+    cProfile only sees the calling thread, so such sections are always
+    sampled, with a one-time warning under PROFILE_MODE=cprofile. Profiling
+    errors are reported on stderr and never replace the enclosed block's
+    outcome.
+    """
+    global _cprofile_warned
+    meta = dict(meta or {})
+    enabled = force or (PROFILE_DIR and random.random() < PROFILE_SAMPLE_RATE)
+    if not enabled:
+        yield meta
+        return
+
+    out_dir = PROFILE_DIR or "profiles"
+    base = os.path.join(out_dir, f"{label}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(_section_ids)}")
+
+    caller = threading.get_ident()
+    use_cprofile = PROFILE_MODE == "cprofile"
+    if use_cprofile and any(tid not in (None, caller) for tid in threads or []):
+        # The caller would just be blocked waiting; cProfile would record that.
+        if not _cprofile_warned:
+            _cprofile_warned = True
+            print(
+                f"[PROFILE] {label}: PROFILE_MODE=cprofile cannot follow other threads; sampling instead",
+                file=sys.stderr,
+            )
+        use_cprofile = False
+
+    traced = False
+    profiler = None
+    sampler = None
+    try:
+        if PROFILE_TRACEMALLOC:
+            _acquire_tracemalloc()
+            traced = True
+        if use_cprofile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            sampler = StackSampler(threads or [caller], PROFILE_INTERVAL_MS / 1000.0)
+            sampler.start()
+    except Exception as exc:
+        print(f"[PROFILE] {label}: could not start profiling: {exc}", file=sys.stderr)
+        profiler = None
+
+    start = time.perf_counter()
+    try:
+        yield meta
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        try:
+            _finish_section(label, base, meta, elapsed_ms, profiler, sampler, traced)
+        except Exception as exc:
+            print(f"[PROFILE] {label}: could not write profile: {exc}", file=sys.stderr)
+
+
+def _finish_section(label, base, meta, elapsed_ms, profiler, sampler, traced):
+    snapshot = None
+    try:
+        if profiler is not None:
+            profiler.disable()
+        if sampler is not None:
+            sampler.stop()
+    finally:
+        if traced:
+            snapshot = _release_tracemalloc()
+
+    if elapsed_ms < PROFILE_MIN_MS:
+        return
+
+    os.makedirs(os.path.dirname(base) or ".", exist_ok=True)
+    if profiler is not None:
+        profiler.dump_stats(base + ".prof")
+    if sampler is not None:
+        sampler.write_collapsed(base + ".collapsed")
+    if snapshot is not None:
+        write_tracemalloc(snapshot, base + ".tracemalloc")
+    meta["label"] = label
+    meta["elapsed_ms"] = round(elapsed_ms, 3)
+    with open(base + ".json", "w") as f:
+        json.dump(meta, f, indent=2)
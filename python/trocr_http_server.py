@@ -1,42 +1,240 @@
 import base64
 import json
 import os
+import socket
 import sys
 import threading
+import time
+import traceback
+from collections import deque
 from io import BytesIO
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from typing import List
+from typing import Iterable, Iterator, List, Tuple
 
 import torch
-from PIL import Image, ImageOps, ImageFilter
-from transformers import TrOCRProcessor, VisionEncoderDecoderModel
+from PIL import Image, ImageDraw, ImageOps, ImageFilter
+from transformers import (
+    TrOCRConfig,
+    TrOCRProcessor,
+    ViTConfig,
+    ViTImageProcessor,
+    VisionEncoderDecoderConfig,
+    VisionEncoderDecoderModel,
+)
+
+from profiling import profile_section
+from trocr_jobs import JobStore
+
+
+def parse_lane_config(spec: str, default_lane: str, bulk_lane: str) -> dict:
+    """Parse TROCR_LANE_WEIGHTS and check the default/bulk lanes exist.
+
+    Raises SystemExit with a readable message, before any model is loaded.
+    """
+    weights = {}
+    for item in spec.split(","):
+        name, sep, weight = item.partition("=")
+        name = name.strip()
+        if not sep or not name:
+            raise SystemExit(f"[SERVER] TROCR_LANE_WEIGHTS: expected 'name=weight', got {item!r}")
+        if name in weights:
+            raise SystemExit(f"[SERVER] TROCR_LANE_WEIGHTS: lane {name!r} listed twice")
+        try:
+            value = float(weight)
+        except ValueError:
+            raise SystemExit(f"[SERVER] TROCR_LANE_WEIGHTS: weight for {name!r} is not a number: {weight!r}")
+        if value <= 0:
+            raise SystemExit(f"[SERVER] TROCR_LANE_WEIGHTS: weight for {name!r} must be positive")
+        weights[name] = value
+
+    for var, lane in (("TROCR_DEFAULT_LANE", default_lane), ("TROCR_BULK_LANE", bulk_lane)):
+        if lane not in weights:
+            raise SystemExit(
+                f"[SERVER] {var}={lane!r} is not a lane in TROCR_LANE_WEIGHTS ({', '.join(weights)})"
+            )
+    return weights
+
 
-MODEL_NAME = os.getenv("TROCR_MODEL", "microsoft/trocr-large-handwritten")
+TINY_MODEL = "tiny"
+MODEL_NAME = TINY_MODEL if "--tiny-model" in sys.argv else os.getenv("TROCR_MODEL", "microsoft/trocr-large-handwritten")
 BATCH_SIZE = int(os.getenv("TROCR_BATCH_SIZE", "16"))
+MAX_LENGTH = int(os.getenv("TROCR_MAX_LENGTH", "256"))
+# Confidence-gated cascade: decode every line with TROCR_FAST_MODEL (greedy),
+# then re-decode lines below TROCR_CASCADE_THRESHOLD with the primary model and
+# TROCR_CASCADE_BEAMS beams. Without a fast model, the cascade re-decodes with
+# the primary model using beam search only (when TROCR_CASCADE_BEAMS > 1).
+FAST_MODEL_NAME = os.getenv("TROCR_FAST_MODEL", "")
+FAST_QUANTIZE = os.getenv("TROCR_FAST_QUANTIZE", "0") == "1"
+CASCADE_THRESHOLD = float(os.getenv("TROCR_CASCADE_THRESHOLD", "0.85"))
+CASCADE_BEAMS = int(os.getenv("TROCR_CASCADE_BEAMS", "1"))
+# Scheduling lanes and their weights, e.g. "interactive=4,bulk=1": when both
+# lanes have work, interactive gets ~4 batches for every bulk batch. /ocr
+# requests pick a lane with an X-Priority header or a "priority" field;
+# async jobs always run in the bulk lane.
+DEFAULT_LANE = os.getenv("TROCR_DEFAULT_LANE", "interactive")
+BULK_LANE = os.getenv("TROCR_BULK_LANE", "bulk")
+LANE_WEIGHTS = parse_lane_config(
+    os.getenv("TROCR_LANE_WEIGHTS", "interactive=4,bulk=1"), DEFAULT_LANE, BULK_LANE
+)
+# Longest a caller waits for its lines to come back from the scheduler.
+SCHEDULER_TIMEOUT_S = float(os.getenv("TROCR_SCHEDULER_TIMEOUT_S", "600"))
+# Optional startup calibration of BATCH_SIZE and torch threads; the winner is
+# cached per host/model in TROCR_AUTOTUNE_CACHE so restarts skip the sweep.
+AUTOTUNE = os.getenv("TROCR_AUTOTUNE", "0") == "1"
+AUTOTUNE_BATCHES = [int(v) for v in os.getenv("TROCR_AUTOTUNE_BATCHES", "1,4,8,16,32").split(",")]
+AUTOTUNE_THREADS = [int(v) for v in os.getenv("TROCR_AUTOTUNE_THREADS", "").split(",") if v]
+AUTOTUNE_BUDGET_MS = float(os.getenv("TROCR_AUTOTUNE_BUDGET_MS", "3000"))
+AUTOTUNE_CACHE = os.getenv("TROCR_AUTOTUNE_CACHE", "cache/trocr_autotune.json")
+# The job queue is shared state: every server started with the same
+# TROCR_JOBS_DB (relative to the working directory) drains the same pending
+# lines. Test, load-test or tiny-model servers must point this elsewhere.
+JOBS_DB = os.getenv("TROCR_JOBS_DB", "cache/trocr_jobs.sqlite3")
+# Backoff for job lines whose batch failed in the model (OOM etc.); they stay
+# pending and are retried after base * 2**attempts seconds, capped at max.
+JOB_RETRY_BASE_S = float(os.getenv("TROCR_JOB_RETRY_BASE_S", "2"))
+JOB_RETRY_MAX_S = float(os.getenv("TROCR_JOB_RETRY_MAX_S", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("TROCR_JOB_MAX_ATTEMPTS", "5"))
+# HTTP/1.1 persistent connections: idle connections are closed after
+# TROCR_KEEPALIVE_TIMEOUT seconds and after TROCR_KEEPALIVE_MAX_REQUESTS.
+KEEPALIVE_TIMEOUT = float(os.getenv("TROCR_KEEPALIVE_TIMEOUT", "15"))
+KEEPALIVE_MAX_REQUESTS = int(os.getenv("TROCR_KEEPALIVE_MAX_REQUESTS", "1000"))
 HOST = os.getenv("TROCR_HOST", "127.0.0.1")
 PORT = int(os.getenv("TROCR_PORT", "8008"))
 
+
+class TinyProcessor:
+    """Offline stand-in for TrOCRProcessor, paired with the tiny random model.
+
+    Decoded text is meaningless; it only needs to exercise the same code path.
+    """
+
+    def __init__(self, image_size: int) -> None:
+        self.image_processor = ViTImageProcessor(size={"height": image_size, "width": image_size})
+
+    def __call__(self, images, return_tensors="pt", padding=True):
+        return self.image_processor(images=images, return_tensors=return_tensors)
+
+    def batch_decode(self, sequences, skip_special_tokens=True) -> List[str]:
+        return [
+            "".join(chr(ord("a") + int(t) % 26) for t in seq if int(t) > 2)
+            for seq in sequences
+        ]
+
+
+def load_tiny_model():
+    # Randomly initialised ViT encoder + TrOCR decoder a few MB in size, so the
+    # server can be load-tested without downloading the real weights.
+    image_size = 64
+    encoder = ViTConfig(
+        image_size=image_size,
+        patch_size=16,
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=128,
+    )
+    decoder = TrOCRConfig(
+        vocab_size=128,
+        d_model=64,
+        decoder_layers=2,
+        decoder_attention_heads=2,
+        decoder_ffn_dim=128,
+        max_position_embeddings=max(512, MAX_LENGTH),
+        pad_token_id=1,
+        bos_token_id=0,
+        eos_token_id=2,
+        decoder_start_token_id=2,
+    )
+    config = VisionEncoderDecoderConfig.from_encoder_decoder_configs(encoder, decoder)
+    config.decoder_start_token_id = 2
+    config.pad_token_id = 1
+    config.eos_token_id = 2
+
+    torch.manual_seed(0)
+    return TinyProcessor(image_size), VisionEncoderDecoderModel(config=config)
+
+
+def load_model(name: str):
+    if name == TINY_MODEL:
+        return load_tiny_model()
+
+    processor = TrOCRProcessor.from_pretrained(name)
+    model = VisionEncoderDecoderModel.from_pretrained(
+        name,
+        use_safetensors=True,
+        low_cpu_mem_usage=True
+    )
+    return processor, model
+
+
 print(f"[SERVER] Loading TrOCR model: {MODEL_NAME}", file=sys.stderr)
-processor = TrOCRProcessor.from_pretrained(MODEL_NAME)
-model = VisionEncoderDecoderModel.from_pretrained(
-    MODEL_NAME,
-    use_safetensors=True,
-    low_cpu_mem_usage=True
-)
+processor, model = load_model(MODEL_NAME)
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(f"[SERVER] Using device: {device}", file=sys.stderr)
 model.to(device)
 model.eval()
 
-try:
-    dummy_image = Image.new("RGB", (384, 384), color="white")
-    _ = processor(images=[dummy_image], return_tensors="pt").pixel_values
-    print("[SERVER] Model loaded and warmed up. Ready for requests.", file=sys.stderr)
-except Exception as exc:
-    print(f"[SERVER] Warmup failed: {exc}", file=sys.stderr)
+fast_processor, fast_model = None, None
+if FAST_MODEL_NAME:
+    print(f"[SERVER] Loading cascade fast model: {FAST_MODEL_NAME}", file=sys.stderr)
+    fast_processor, fast_model = load_model(FAST_MODEL_NAME)
+    fast_model.to(device)
+    fast_model.eval()
+    if FAST_QUANTIZE and device.type == "cpu":
+        fast_model = torch.quantization.quantize_dynamic(
+            fast_model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+CASCADE_ENABLED = fast_model is not None or CASCADE_BEAMS > 1
+
+
+class ServerStats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.lines = 0
+        self.batches = 0
+        self.redecoded = 0
+
+    def record_batch(self, size: int, redecoded: int = 0) -> None:
+        with self.lock:
+            self.batches += 1
+            self.lines += size
+            self.redecoded += redecoded
+
+    def record_request(self) -> None:
+        with self.lock:
+            self.requests += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            batch_fill = self.lines / float(self.batches * BATCH_SIZE) if self.batches else 0.0
+            return {
+                "model": MODEL_NAME,
+                "batch_size": BATCH_SIZE,
+                "requests": self.requests,
+                "lines": self.lines,
+                "batches": self.batches,
+                "redecoded": self.redecoded,
+                "batch_fill": batch_fill,
+                "rss_kb": current_rss_kb(),
+            }
+
+
+def current_rss_kb() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
 
-sys.stderr.flush()
+stats = ServerStats()
 
 
 def preprocess_pil(image: Image.Image) -> Image.Image:
@@ -63,121 +261,653 @@ def preprocess_b64_image(b64_data: str) -> Image.Image:
     return preprocess_pil(image)
 
 
-def process_batch(image_paths: List[str]) -> List[str]:
-    if not image_paths:
-        return []
+def generate_with_confidence(
+    proc, mdl, images: List[Image.Image], num_beams: int = 1
+) -> Tuple[List[str], List[float]]:
+    pixel_values = proc(
+        images=images,
+        return_tensors="pt",
+        padding=True
+    ).pixel_values
+    pixel_values = pixel_values.to(device)
+
+    with torch.no_grad():
+        output = mdl.generate(
+            pixel_values,
+            max_length=MAX_LENGTH,
+            num_beams=num_beams,
+            early_stopping=True,
+            length_penalty=1.0,
+            output_scores=True,
+            return_dict_in_generate=True
+        )
+
+    sequences = output.sequences
+    if num_beams > 1:
+        # Already the length-normalised log-prob of the chosen beam.
+        mean_logprob = output.sequences_scores
+    else:
+        token_logprobs = mdl.compute_transition_scores(
+            sequences, output.scores, normalize_logits=True
+        )
+        pad_id = mdl.config.pad_token_id
+        generated = sequences[:, -token_logprobs.shape[1]:]
+        mask = (generated != pad_id) & torch.isfinite(token_logprobs)
+        token_logprobs = torch.where(mask, token_logprobs, torch.zeros_like(token_logprobs))
+        mean_logprob = token_logprobs.sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+    texts = proc.batch_decode(sequences, skip_special_tokens=True)
+    confidences = [float(c) for c in torch.exp(mean_logprob).cpu()]
+    return texts, confidences
 
+
+def recognize(images: List[Image.Image]) -> Tuple[List[str], List[float]]:
     results: List[str] = []
-    for i in range(0, len(image_paths), BATCH_SIZE):
-        batch_paths = image_paths[i : i + BATCH_SIZE]
-        images = [preprocess_image(p) for p in batch_paths]
+    confidences: List[float] = []
+    for i in range(0, len(images), BATCH_SIZE):
+        batch = images[i : i + BATCH_SIZE]
 
-        if not images:
-            continue
-
-        pixel_values = processor(
-            images=images,
-            return_tensors="pt",
-            padding=True
-        ).pixel_values
-        pixel_values = pixel_values.to(device)
-
-        with torch.no_grad():
-            generated_ids = model.generate(
-                pixel_values,
-                max_length=256,
-                num_beams=1,
-                early_stopping=True,
-                length_penalty=1.0
+        if fast_model is not None:
+            texts, confs = generate_with_confidence(fast_processor, fast_model, batch)
+        else:
+            texts, confs = generate_with_confidence(processor, model, batch)
+
+        uncertain = []
+        if CASCADE_ENABLED:
+            uncertain = [j for j, c in enumerate(confs) if c < CASCADE_THRESHOLD]
+        if uncertain:
+            retexts, reconfs = generate_with_confidence(
+                processor, model, [batch[j] for j in uncertain], num_beams=CASCADE_BEAMS
             )
+            for j, text, conf in zip(uncertain, retexts, reconfs):
+                texts[j] = text
+                confs[j] = conf
 
-        batch_results = processor.batch_decode(
-            generated_ids,
-            skip_special_tokens=True
-        )
-        results.extend(batch_results)
+        results.extend(texts)
+        confidences.extend(confs)
+        stats.record_batch(len(batch), redecoded=len(uncertain))
 
-    return results
+    return results, confidences
 
 
-def process_b64_batch(images_b64: List[str]) -> List[str]:
-    if not images_b64:
-        return []
+def synthetic_lines(count: int) -> List[Image.Image]:
+    images = []
+    for i in range(count):
+        image = Image.new("RGB", (640, 64), color="white")
+        draw = ImageDraw.Draw(image)
+        draw.text((16, 24), f"calibration line {i} the quick brown fox", fill="black")
+        images.append(preprocess_pil(image))
+    return images
 
-    results: List[str] = []
-    for i in range(0, len(images_b64), BATCH_SIZE):
-        batch_data = images_b64[i : i + BATCH_SIZE]
-        images = [preprocess_b64_image(b64) for b64 in batch_data]
 
-        if not images:
-            continue
-
-        pixel_values = processor(
-            images=images,
-            return_tensors="pt",
-            padding=True
-        ).pixel_values
-        pixel_values = pixel_values.to(device)
-
-        with torch.no_grad():
-            generated_ids = model.generate(
-                pixel_values,
-                max_length=256,
-                num_beams=1,
-                early_stopping=True,
-                length_penalty=1.0
+def warmup() -> None:
+    try:
+        recognize(synthetic_lines(1))
+        print("[SERVER] Model loaded and warmed up. Ready for requests.", file=sys.stderr)
+    except Exception as exc:
+        print(f"[SERVER] Warmup failed: {exc}", file=sys.stderr)
+    sys.stderr.flush()
+
+
+def autotune_key() -> str:
+    return "|".join([
+        socket.gethostname(),
+        MODEL_NAME,
+        FAST_MODEL_NAME,
+        str(device),
+        str(os.cpu_count()),
+        str(MAX_LENGTH),
+    ])
+
+
+def autotune_inputs() -> dict:
+    # What was swept and under which limits; stored with the cached choice so
+    # a changed grid, budget or quantisation setting forces recalibration.
+    return {
+        "batches": AUTOTUNE_BATCHES,
+        "threads": AUTOTUNE_THREADS,
+        "budget_ms": AUTOTUNE_BUDGET_MS,
+        "fast_quantize": FAST_QUANTIZE,
+    }
+
+
+def load_autotune(key: str):
+    try:
+        with open(AUTOTUNE_CACHE) as f:
+            choice = json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+    if choice is None:
+        return None
+    if choice.get("inputs") != autotune_inputs():
+        print("[SERVER] Autotune settings changed since the cached result; recalibrating", file=sys.stderr)
+        return None
+    return choice
+
+
+def save_autotune(key: str, choice: dict) -> None:
+    try:
+        with open(AUTOTUNE_CACHE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[key] = choice
+
+    directory = os.path.dirname(AUTOTUNE_CACHE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = AUTOTUNE_CACHE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_path, AUTOTUNE_CACHE)
+
+
+def calibrate() -> dict:
+    """Time real first-pass generate calls over the batch x thread grid.
+
+    Picks the highest lines/s whose per-batch latency fits the budget, or the
+    fastest batch if nothing does.
+    """
+    cpu_count = os.cpu_count() or 1
+    threads_grid = AUTOTUNE_THREADS or sorted({1, max(1, cpu_count // 4), max(1, cpu_count // 2), cpu_count})
+    first_pass = (fast_processor, fast_model) if fast_model is not None else (processor, model)
+    images = synthetic_lines(max(AUTOTUNE_BATCHES))
+
+    trials = []
+    for threads in threads_grid:
+        torch.set_num_threads(threads)
+        for batch_size in AUTOTUNE_BATCHES:
+            batch = images[:batch_size]
+            generate_with_confidence(*first_pass, batch)
+            timings = []
+            for _ in range(2):
+                start = time.perf_counter()
+                generate_with_confidence(*first_pass, batch)
+                timings.append((time.perf_counter() - start) * 1000.0)
+            batch_ms = min(timings)
+            trial = {
+                "batch_size": batch_size,
+                "threads": threads,
+                "batch_ms": round(batch_ms, 3),
+                "lines_per_s": round(batch_size / (batch_ms / 1000.0), 3),
+            }
+            print(f"[SERVER] Autotune {trial}", file=sys.stderr)
+            trials.append(trial)
+
+    within_budget = [t for t in trials if t["batch_ms"] <= AUTOTUNE_BUDGET_MS]
+    if within_budget:
+        return max(within_budget, key=lambda t: t["lines_per_s"])
+    return min(trials, key=lambda t: t["batch_ms"])
+
+
+def autotune() -> None:
+    global BATCH_SIZE
+
+    key = autotune_key()
+    choice = load_autotune(key)
+    if choice is None:
+        print("[SERVER] Calibrating batch size and thread count...", file=sys.stderr)
+        choice = dict(calibrate(), inputs=autotune_inputs())
+        save_autotune(key, choice)
+    else:
+        print(f"[SERVER] Using cached autotune result for {key}", file=sys.stderr)
+
+    BATCH_SIZE = int(choice["batch_size"])
+    torch.set_num_threads(int(choice["threads"]))
+    print(
+        f"[SERVER] Batch size {BATCH_SIZE}, {choice['threads']} torch threads",
+        file=sys.stderr,
+    )
+    sys.stderr.flush()
+
+
+warmup()
+if AUTOTUNE:
+    autotune()
+
+
+class WorkItem:
+    __slots__ = ("image", "enqueued", "done", "text", "confidence", "error")
+
+    def __init__(self, image: Image.Image) -> None:
+        self.image = image
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.text = ""
+        self.confidence = 0.0
+        self.error = None
+
+
+class LaneScheduler:
+    """Forms model batches from per-priority lanes with weighted fairness.
+
+    A single thread runs every generate call. Each batch is led by the lane
+    chosen by smooth weighted round-robin over the non-empty lanes, then
+    topped up from the other lanes so no batch slot is wasted.
+    """
+
+    def __init__(self, weights: dict, batch_size: int) -> None:
+        self.weights = weights
+        self.batch_size = batch_size
+        self.lanes = {name: deque() for name in weights}
+        self.credit = {name: 0.0 for name in weights}
+        self.served = {name: 0 for name in weights}
+        self.latency_ms = {name: deque(maxlen=2000) for name in weights}
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="trocr-scheduler", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def lane_for(self, name: str) -> str:
+        if name in self.lanes:
+            return name
+        raise ValueError(f"unknown priority '{name}', expected one of {sorted(self.lanes)}")
+
+    def submit(self, images: List[Image.Image], lane: str) -> List[WorkItem]:
+        items = [WorkItem(image) for image in images]
+        with self.cond:
+            self.lanes[lane].extend(items)
+            self.cond.notify()
+        return items
+
+    def recognize(self, images: List[Image.Image], lane: str) -> Tuple[List[str], List[float]]:
+        return self.recognize_chunks([images], lane)
+
+    def recognize_chunks(self, chunks: Iterable[List[Image.Image]], lane: str) -> Tuple[List[str], List[float]]:
+        """Submit lazily produced chunks of images and wait for all of them.
+
+        The next chunk is only produced once at most one earlier chunk is still
+        queued, so decoding overlaps inference without holding every decoded
+        image of a large request at once.
+        """
+        if not self.thread.is_alive():
+            raise RuntimeError("OCR scheduler is not running")
+
+        deadline = time.monotonic() + SCHEDULER_TIMEOUT_S
+        submitted = []
+        outstanding = deque()
+        try:
+            for images in chunks:
+                if len(outstanding) >= 2:
+                    self._wait(outstanding.popleft(), deadline)
+                items = self.submit(images, lane)
+                submitted.extend(items)
+                outstanding.append(items)
+            while outstanding:
+                self._wait(outstanding.popleft(), deadline)
+        except BaseException:
+            self._withdraw(lane, submitted)
+            raise
+
+        for item in submitted:
+            if item.error is not None:
+                raise item.error
+        return [item.text for item in submitted], [item.confidence for item in submitted]
+
+    def _wait(self, items: List[WorkItem], deadline: float) -> None:
+        for item in items:
+            while not item.done.wait(1.0):
+                if not self.thread.is_alive():
+                    raise RuntimeError("OCR scheduler stopped while lines were queued")
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"OCR lines not processed within {SCHEDULER_TIMEOUT_S:g}s")
+
+    def _withdraw(self, lane: str, items: List[WorkItem]) -> None:
+        # Drop lines no one is waiting for any more, if not already batched.
+        abandoned = set(map(id, items))
+        with self.cond:
+            queue = self.lanes[lane]
+            kept = [item for item in queue if id(item) not in abandoned]
+            queue.clear()
+            queue.extend(kept)
+
+    def _pick_lane(self) -> str:
+        active = [name for name, queue in self.lanes.items() if queue]
+        total = sum(self.weights[name] for name in active)
+        for name in active:
+            self.credit[name] += self.weights[name]
+        lane = max(active, key=lambda name: self.credit[name])
+        self.credit[lane] -= total
+        return lane
+
+    def _next_batch(self) -> List[Tuple[str, WorkItem]]:
+        with self.cond:
+            while not any(self.lanes.values()):
+                self.cond.wait()
+
+            lead = self._pick_lane()
+            order = [lead] + sorted(
+                (name for name in self.lanes if name != lead),
+                key=lambda name: -self.weights[name],
             )
+            batch = []
+            for name in order:
+                queue = self.lanes[name]
+                while queue and len(batch) < self.batch_size:
+                    batch.append((name, queue.popleft()))
+            return batch
+
+    def run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            try:
+                texts, confidences = recognize([item.image for _, item in batch])
+                for (_, item), text, confidence in zip(batch, texts, confidences):
+                    item.text = text
+                    item.confidence = confidence
+            except Exception as exc:
+                for _, item in batch:
+                    item.error = exc
+
+            now = time.perf_counter()
+            with self.cond:
+                for name, item in batch:
+                    self.served[name] += 1
+                    self.latency_ms[name].append((now - item.enqueued) * 1000.0)
+            for _, item in batch:
+                item.image = None
+                item.done.set()
+
+    def snapshot(self) -> dict:
+        with self.cond:
+            lanes = {}
+            for name in self.lanes:
+                latencies = sorted(self.latency_ms[name])
+                lanes[name] = {
+                    "weight": self.weights[name],
+                    "depth": len(self.lanes[name]),
+                    "served": self.served[name],
+                    "p50_ms": percentile(latencies, 50),
+                    "p95_ms": percentile(latencies, 95),
+                }
+            return lanes
+
+
+def percentile(ordered: List[float], pct: float) -> float:
+    if not ordered:
+        return 0.0
+    k = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return round(ordered[k], 3)
+
+
+scheduler = LaneScheduler(LANE_WEIGHTS, BATCH_SIZE)
+
+
+def preprocess_chunks(sources: List[str], preprocess) -> Iterator[List[Image.Image]]:
+    for i in range(0, len(sources), BATCH_SIZE):
+        yield [preprocess(source) for source in sources[i : i + BATCH_SIZE]]
+
+
+def process_batch(image_paths: List[str], lane: str = DEFAULT_LANE) -> Tuple[List[str], List[float]]:
+    if not image_paths:
+        return [], []
+    return scheduler.recognize_chunks(preprocess_chunks(image_paths, preprocess_image), lane)
 
-        batch_results = processor.batch_decode(
-            generated_ids,
-            skip_special_tokens=True
-        )
-        results.extend(batch_results)
 
-    return results
+def process_b64_batch(images_b64: List[str], lane: str = DEFAULT_LANE) -> Tuple[List[str], List[float]]:
+    if not images_b64:
+        return [], []
+    return scheduler.recognize_chunks(preprocess_chunks(images_b64, preprocess_b64_image), lane)
+
+
+class JobWorker:
+    """Drains pending job lines from the store in BATCH_SIZE batches."""
+
+    def __init__(self, store: JobStore) -> None:
+        self.store = store
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="trocr-jobs", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def notify(self) -> None:
+        self.wakeup.set()
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.wakeup.clear()
+                rows = self.store.next_pending(BATCH_SIZE)
+                if not rows:
+                    self.wakeup.wait(1.0)
+                    continue
+                self.process(rows)
+            except Exception:
+                # Keep draining: a store error must not silently stop the queue.
+                print("[SERVER] Job worker iteration failed:", file=sys.stderr)
+                traceback.print_exc()
+                sys.stderr.flush()
+                time.sleep(1.0)
+
+    def process(self, rows) -> None:
+        keys = []
+        images = []
+        for job_id, idx, kind, data in rows:
+            try:
+                image = preprocess_b64_image(data) if kind == "image" else preprocess_image(data)
+            except Exception as exc:
+                self.store.fail(job_id, f"line {idx}: {exc}")
+                continue
+            keys.append((job_id, idx))
+            images.append(image)
+
+        if not images:
+            return
+
+        try:
+            texts, confidences = scheduler.recognize(images, BULK_LANE)
+        except Exception as exc:
+            if len(images) == 1:
+                self.retry(keys, exc)
+                return
+            # Batches mix unrelated jobs; run each line alone so one bad line
+            # only holds back (and eventually fails) its own job.
+            print(f"[SERVER] Job batch of {len(keys)} failed, retrying lines singly: {exc}", file=sys.stderr)
+            for key, image in zip(keys, images):
+                self.process_one(key, image)
+            return
+
+        self.store.complete_lines([
+            (job_id, idx, text, confidence)
+            for (job_id, idx), text, confidence in zip(keys, texts, confidences)
+        ])
+
+    def process_one(self, key, image) -> None:
+        try:
+            texts, confidences = scheduler.recognize([image], BULK_LANE)
+        except Exception as exc:
+            self.retry([key], exc)
+            return
+        self.store.complete_lines([(key[0], key[1], texts[0], confidences[0])])
+
+    def retry(self, keys, exc) -> None:
+        failed = self.store.retry_lines(keys, str(exc), JOB_RETRY_BASE_S, JOB_RETRY_MAX_S, JOB_MAX_ATTEMPTS)
+        for job_id in failed:
+            print(f"[SERVER] Job {job_id} failed after {JOB_MAX_ATTEMPTS} attempts: {exc}", file=sys.stderr)
+
+
+job_store = JobStore(JOBS_DB)
+job_worker = JobWorker(job_store)
 
 
 class TrOcrHandler(BaseHTTPRequestHandler):
-    server_version = "TrOCRHTTP/1.0"
+    server_version = "TrOCRHTTP/1.1"
+    protocol_version = "HTTP/1.1"
+    # Socket timeout; an idle keep-alive connection is dropped when it expires.
+    timeout = KEEPALIVE_TIMEOUT
+
+    def setup(self) -> None:
+        super().setup()
+        self.requests_served = 0
 
     def _send_json(self, status_code: int, payload: dict) -> None:
         body = json.dumps(payload).encode("utf-8")
+        self.requests_served += 1
+        if self.requests_served >= KEEPALIVE_MAX_REQUESTS:
+            self.close_connection = True
+
         self.send_response(status_code)
         self.send_header("Content-Type", "application/json; charset=utf-8")
         self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        else:
+            self.send_header("Connection", "keep-alive")
+            self.send_header(
+                "Keep-Alive",
+                f"timeout={int(KEEPALIVE_TIMEOUT)}, max={KEEPALIVE_MAX_REQUESTS - self.requests_served}",
+            )
         self.end_headers()
         self.wfile.write(body)
 
+    def _read_body(self) -> bytes:
+        # The whole body must be consumed, even for requests we reject, or the
+        # next request on this connection would start mid-body.
+        try:
+            if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline(65537).split(b";", 1)[0].strip(), 16)
+                    if size == 0:
+                        while self.rfile.readline(65537) not in (b"\r\n", b"\n", b""):
+                            pass
+                        break
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline(65537)
+                return b"".join(chunks)
+
+            content_length = int(self.headers.get("Content-Length", "0"))
+            return self.rfile.read(content_length) if content_length > 0 else b""
+        except ValueError:
+            # Framing is unknown, so the connection cannot be reused.
+            self.close_connection = True
+            raise
+
+    def _read_json(self) -> dict:
+        raw = self._read_body()
+        return json.loads(raw.decode("utf-8")) if raw else {}
+
+    def _read_lines(self, data: dict):
+        # Returns (image_paths, images_b64), or None after sending a 400.
+        image_paths = data.get("paths", [])
+        images_b64 = data.get("images", [])
+
+        if image_paths and not isinstance(image_paths, list):
+            self._send_json(400, {"error": "'paths' must be a list"})
+            return None
+        if images_b64 and not isinstance(images_b64, list):
+            self._send_json(400, {"error": "'images' must be a list"})
+            return None
+        return image_paths, images_b64
+
     def do_GET(self) -> None:
         if self.path == "/health":
             self._send_json(200, {"status": "ok"})
+        elif self.path == "/stats":
+            self._send_json(200, dict(
+                stats.snapshot(),
+                jobs=job_store.counts(),
+                lanes=scheduler.snapshot(),
+            ))
+        elif self.path.startswith("/jobs/"):
+            self._get_job(self.path[len("/jobs/"):])
         else:
             self._send_json(404, {"error": "Not found"})
 
+    def _get_job(self, rest: str) -> None:
+        job_id, _, suffix = rest.partition("/")
+        if suffix not in ("", "result"):
+            self._send_json(404, {"error": "Not found"})
+            return
+
+        job = job_store.get(job_id)
+        if job is None:
+            self._send_json(404, {"error": "Unknown job"})
+            return
+
+        if suffix == "":
+            self._send_json(200, job)
+        elif job["status"] == "done":
+            self._send_json(200, {
+                "id": job_id,
+                "results": job["results"],
+                "confidences": job["confidences"],
+            })
+        elif job["status"] == "failed":
+            self._send_json(500, {"id": job_id, "error": job["error"]})
+        else:
+            self._send_json(202, {
+                "id": job_id,
+                "status": job["status"],
+                "total": job["total"],
+                "done": job["done"],
+            })
+
     def do_POST(self) -> None:
+        if self.path == "/jobs":
+            self._post_job()
+            return
         if self.path != "/ocr":
+            try:
+                self._read_body()
+            except ValueError:
+                pass
             self._send_json(404, {"error": "Not found"})
             return
 
         try:
-            content_length = int(self.headers.get("Content-Length", "0"))
-            raw = self.rfile.read(content_length)
-            data = json.loads(raw.decode("utf-8")) if raw else {}
-            image_paths = data.get("paths", [])
-            images_b64 = data.get("images", [])
-
-            if image_paths and not isinstance(image_paths, list):
-                self._send_json(400, {"error": "'paths' must be a list"})
+            data = self._read_json()
+            lines = self._read_lines(data)
+            if lines is None:
                 return
-            if images_b64 and not isinstance(images_b64, list):
-                self._send_json(400, {"error": "'images' must be a list"})
+            image_paths, images_b64 = lines
+
+            try:
+                lane = scheduler.lane_for(
+                    self.headers.get("X-Priority") or data.get("priority") or DEFAULT_LANE
+                )
+            except ValueError as exc:
+                self._send_json(400, {"error": str(exc)})
                 return
 
+            # X-Profile: 1 profiles this request regardless of PROFILE_DIR.
+            force_profile = self.headers.get("X-Profile", "") == "1"
+            meta = {"lines": len(images_b64 or image_paths), "batch_size": BATCH_SIZE, "lane": lane}
+            with profile_section(
+                "trocr-ocr",
+                force=force_profile,
+                meta=meta,
+                threads=[threading.get_ident(), scheduler.thread.ident],
+            ):
+                if images_b64:
+                    results, confidences = process_b64_batch(images_b64, lane)
+                else:
+                    results, confidences = process_batch(image_paths, lane)
+            stats.record_request()
+            self._send_json(200, {"results": results, "confidences": confidences})
+        except json.JSONDecodeError as exc:
+            self._send_json(400, {"error": f"Invalid JSON: {exc}"})
+        except Exception as exc:
+            self._send_json(500, {"error": str(exc)})
+
+    def _post_job(self) -> None:
+        try:
+            data = self._read_json()
+            lines = self._read_lines(data)
+            if lines is None:
+                return
+            image_paths, images_b64 = lines
+
             if images_b64:
-                results = process_b64_batch(images_b64)
+                job_id = job_store.create("image", images_b64, meta=data.get("meta"))
             else:
-                results = process_batch(image_paths)
-            self._send_json(200, {"results": results})
+                job_id = job_store.create("path", image_paths, meta=data.get("meta"))
+            job_worker.notify()
+
+            job = job_store.get(job_id)
+            self._send_json(202, {"id": job_id, "status": job["status"], "total": job["total"]})
         except json.JSONDecodeError as exc:
             self._send_json(400, {"error": f"Invalid JSON: {exc}"})
         except Exception as exc:
@@ -190,6 +920,8 @@ class TrOcrHandler(BaseHTTPRequestHandler):
 
 def main() -> None:
     server = ThreadingHTTPServer((HOST, PORT), TrOcrHandler)
+    scheduler.start()
+    job_worker.start()
     print(f"[SERVER] Listening on http://{HOST}:{PORT}", file=sys.stderr)
     sys.stderr.flush()
 
@@ -0,0 +1,218 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    total INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    meta TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS lines (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL,
+    text TEXT,
+    confidence REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS lines_pending ON lines (job_id, idx) WHERE text IS NULL;
+"""
+
+# Columns added after the first release; ALTERed into older databases.
+LINE_MIGRATIONS = [
+    ("attempts", "INTEGER NOT NULL DEFAULT 0"),
+    ("next_attempt", "REAL NOT NULL DEFAULT 0"),
+    ("last_error", "TEXT"),
+]
+
+
+class JobStore:
+    """Persistent OCR job queue backed by sqlite.
+
+    Lines without text are pending; a restarted server simply picks them up
+    again, so unfinished jobs resume where they stopped.
+    """
+
+    def __init__(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(lines)")}
+        for name, decl in LINE_MIGRATIONS:
+            if name not in columns:
+                self.conn.execute(f"ALTER TABLE lines ADD COLUMN {name} {decl}")
+        self.conn.commit()
+
+    def create(self, kind: str, items: List[str], meta: Optional[dict] = None) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        status = "queued" if items else "done"
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO jobs (id, status, created, updated, total, meta) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, status, now, now, len(items), json.dumps(meta or {})),
+            )
+            self.conn.executemany(
+                "INSERT INTO lines (job_id, idx, kind, data) VALUES (?, ?, ?, ?)",
+                [(job_id, idx, kind, data) for idx, data in enumerate(items)],
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self.lock:
+            job = self.conn.execute(
+                "SELECT status, created, updated, total, done, meta, error FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+            if job is None:
+                return None
+            lines = self.conn.execute(
+                "SELECT text, confidence, attempts, last_error FROM lines WHERE job_id = ? ORDER BY idx",
+                (job_id,),
+            ).fetchall()
+
+        status, created, updated, total, done, meta, error = job
+        return {
+            "id": job_id,
+            "status": status,
+            "created": created,
+            "updated": updated,
+            "total": total,
+            "done": done,
+            "meta": json.loads(meta) if meta else {},
+            "error": error,
+            "results": [line[0] for line in lines],
+            "confidences": [line[1] for line in lines],
+            "retrying": [
+                {"index": idx, "attempts": line[2], "error": line[3]}
+                for idx, line in enumerate(lines)
+                if line[0] is None and line[2] > 0
+            ],
+        }
+
+    def next_pending(self, limit: int) -> List[Tuple[str, int, str, str]]:
+        """Oldest pending lines across running/queued jobs, in job order.
+
+        Lines backing off after a failed attempt are skipped until due.
+        """
+        with self.lock:
+            return self.conn.execute(
+                """
+                SELECT l.job_id, l.idx, l.kind, l.data
+                FROM lines l JOIN jobs j ON j.id = l.job_id
+                WHERE l.text IS NULL AND j.status IN ('queued', 'running')
+                    AND l.next_attempt <= ?
+                ORDER BY j.created, l.job_id, l.idx
+                LIMIT ?
+                """,
+                (time.time(), limit),
+            ).fetchall()
+
+    def retry_lines(
+        self,
+        keys: List[Tuple[str, int]],
+        error: str,
+        base_delay: float,
+        max_delay: float,
+        max_attempts: int,
+    ) -> List[str]:
+        """Leave lines pending after a failure, with exponential backoff.
+
+        A line that has failed ``max_attempts`` times fails its whole job so a
+        line the model can never read does not stay queued forever. Returns the
+        ids of jobs failed this way.
+        """
+        now = time.time()
+        failed = []
+        with self.lock, self.conn:
+            for job_id, idx in keys:
+                attempts = self.conn.execute(
+                    "SELECT attempts FROM lines WHERE job_id = ? AND idx = ?",
+                    (job_id, idx),
+                ).fetchone()
+                if attempts is None:
+                    continue
+                attempts = attempts[0] + 1
+                delay = min(max_delay, base_delay * (2 ** (attempts - 1)))
+                self.conn.execute(
+                    """
+                    UPDATE lines SET attempts = ?, next_attempt = ?, last_error = ?
+                    WHERE job_id = ? AND idx = ?
+                    """,
+                    (attempts, now + delay, error, job_id, idx),
+                )
+                if attempts >= max_attempts:
+                    self.conn.execute(
+                        """
+                        UPDATE jobs SET status = 'failed', error = ?, updated = ?
+                        WHERE id = ? AND status != 'failed'
+                        """,
+                        (f"line {idx}: gave up after {attempts} attempts: {error}", now, job_id),
+                    )
+                    failed.append(job_id)
+        return failed
+
+    def complete_lines(self, rows: List[Tuple[str, int, str, float]]) -> None:
+        now = time.time()
+        job_ids = sorted({job_id for job_id, _, _, _ in rows})
+        with self.lock, self.conn:
+            # Image payloads are dropped once decoded; only the text is kept.
+            self.conn.executemany(
+                "UPDATE lines SET text = ?, confidence = ?, data = '' WHERE job_id = ? AND idx = ? AND text IS NULL",
+                [(text, confidence, job_id, idx) for job_id, idx, text, confidence in rows],
+            )
+            for job_id in job_ids:
+                self.conn.execute(
+                    """
+                    UPDATE jobs SET
+                        done = (SELECT COUNT(*) FROM lines WHERE job_id = ? AND text IS NOT NULL),
+                        updated = ?
+                    WHERE id = ?
+                    """,
+                    (job_id, now, job_id),
+                )
+                self.conn.execute(
+                    """
+                    UPDATE jobs SET status = CASE WHEN done >= total THEN 'done' ELSE 'running' END
+                    WHERE id = ? AND status != 'failed'
+                    """,
+                    (job_id,),
+                )
+
+    def fail(self, job_id: str, error: str) -> None:
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                (error, time.time(), job_id),
+            )
+
+    def counts(self) -> dict:
+        with self.lock:
+            rows = self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+            pending = self.conn.execute(
+                """
+                SELECT COUNT(*) FROM lines l JOIN jobs j ON j.id = l.job_id
+                WHERE l.text IS NULL AND j.status IN ('queued', 'running')
+                """
+            ).fetchone()[0]
+        result = {status: count for status, count in rows}
+        result["pending_lines"] = pending
+        return result
@@ -0,0 +1,254 @@
+"""Offline load generator for trocr_http_server.py.
+
+Replays concurrent /ocr requests built from synthetic line crops and reports
+throughput, latency percentiles, batch fill and server RSS per run.
+
+    # against a running server
+    python python/trocr_loadtest.py --url http://127.0.0.1:8008
+
+    # spawn a tiny-model server per TROCR_BATCH_SIZE value (no network needed)
+    python python/trocr_loadtest.py --spawn --batch-sizes 4,16,32 --concurrency 1,4,16
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import random
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import List
+from urllib.parse import urlparse
+
+from PIL import Image, ImageDraw, ImageFont
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trocr_http_server.py")
+
+
+def synthetic_line(rng: random.Random) -> str:
+    words = [
+        "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9)))
+        for _ in range(rng.randint(3, 10))
+    ]
+    text = " ".join(words)
+    font = ImageFont.load_default()
+    width = max(200, 8 * len(text) + 40)
+    image = Image.new("L", (width, 48), color=255)
+    draw = ImageDraw.Draw(image)
+    draw.text((20, 16), text, fill=0, font=font)
+
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+class Client:
+    def __init__(self, url: str, keepalive: bool = True) -> None:
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 80
+        self.keepalive = keepalive
+        self.local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self.local, "conn", None) if self.keepalive else None
+        if conn is None:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=600)
+            self.local.conn = conn
+        return conn
+
+    def _drop(self) -> None:
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+        self.local.conn = None
+
+    def request(self, method: str, path: str, payload=None, headers=None):
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        all_headers = {"Content-Type": "application/json"}
+        all_headers.update(headers or {})
+
+        # A pooled connection may have been closed by the server's idle timeout
+        # or request limit; retry once on a fresh one.
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=body, headers=all_headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                self._drop()
+                if attempt:
+                    raise
+                continue
+            if not self.keepalive or response.will_close:
+                self._drop()
+            return response.status, json.loads(data) if data else {}
+
+
+def wait_for_health(client: Client, timeout: float, proc=None) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        # A spawned server that died must not be mistaken for whatever else
+        # answers on the port.
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"spawned server exited with code {proc.returncode}")
+        try:
+            status, _ = client.request("GET", "/health")
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError("server did not become healthy")
+
+
+def run_level(client: Client, pool: List[str], concurrency: int, requests: int, lines: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    payloads = [{"images": rng.sample(pool, min(lines, len(pool)))} for _ in range(requests)]
+
+    _, before = client.request("GET", "/stats")
+
+    def send(payload):
+        start = time.perf_counter()
+        status, data = client.request("POST", "/ocr", payload)
+        if status != 200:
+            raise RuntimeError(data.get("error", f"HTTP {status}"))
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(send, payloads))
+    elapsed = time.perf_counter() - start
+
+    _, after = client.request("GET", "/stats")
+    batches = after["batches"] - before["batches"]
+    batch_lines = after["lines"] - before["lines"]
+
+    return {
+        "batch_size": after["batch_size"],
+        "concurrency": concurrency,
+        "requests": requests,
+        "lines_per_s": batch_lines / elapsed if elapsed else 0.0,
+        "requests_per_s": requests / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000.0,
+        "p95_ms": percentile(latencies, 95) * 1000.0,
+        "p99_ms": percentile(latencies, 99) * 1000.0,
+        "batch_fill": batch_lines / float(batches * after["batch_size"]) if batches else 0.0,
+        "rss_kb": after["rss_kb"],
+    }
+
+
+def format_row(row: dict) -> str:
+    return (
+        f"batch={row['batch_size']:<3} conc={row['concurrency']:<3} "
+        f"lines/s={row['lines_per_s']:8.1f} req/s={row['requests_per_s']:6.2f} "
+        f"p50={row['p50_ms']:8.1f}ms p95={row['p95_ms']:8.1f}ms p99={row['p99_ms']:8.1f}ms "
+        f"fill={row['batch_fill']:.2f} rss={row['rss_kb'] // 1024}MB"
+    )
+
+
+def port_in_use(port: int) -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        return sock.connect_ex(("127.0.0.1", port)) == 0
+
+
+def run_against(url: str, args, pool: List[str], proc=None, batch_size=None) -> List[dict]:
+    client = Client(url, keepalive=not args.no_keepalive)
+    wait_for_health(client, args.startup_timeout, proc)
+
+    if batch_size is not None:
+        _, server_stats = client.request("GET", "/stats")
+        if server_stats.get("batch_size") != batch_size:
+            raise RuntimeError(
+                f"server reports batch_size={server_stats.get('batch_size')}, expected {batch_size}"
+            )
+
+    rows = []
+    for concurrency in args.concurrency:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"spawned server exited with code {proc.returncode}")
+        row = run_level(client, pool, concurrency, args.requests, args.lines, args.seed)
+        print(format_row(row))
+        sys.stdout.flush()
+        rows.append(row)
+    return rows
+
+
+def spawn_server(port: int, batch_size: int, args, state_dir: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    # Never share the real job queue: a random-weight server would drain its
+    # pending lines and mark them done with garbage text.
+    env["TROCR_JOBS_DB"] = os.path.join(state_dir, f"jobs-{batch_size}.sqlite3")
+    env["TROCR_MODEL"] = args.model
+    env["TROCR_BATCH_SIZE"] = str(batch_size)
+    env["TROCR_PORT"] = str(port)
+    env["TROCR_MAX_LENGTH"] = str(args.max_length)
+    # Autotuning would replace the batch size under test.
+    env["TROCR_AUTOTUNE"] = "0"
+    return subprocess.Popen([sys.executable, SERVER_SCRIPT], env=env)
+
+
+def parse_ints(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8008")
+    parser.add_argument("--spawn", action="store_true", help="start a server per batch size")
+    parser.add_argument("--model", default="tiny", help="TROCR_MODEL for spawned servers")
+    parser.add_argument("--max-length", type=int, default=32, help="TROCR_MAX_LENGTH for spawned servers")
+    parser.add_argument("--batch-sizes", type=parse_ints, default=[16])
+    parser.add_argument("--concurrency", type=parse_ints, default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=32, help="requests per concurrency level")
+    parser.add_argument("--lines", type=int, default=20, help="line crops per request")
+    parser.add_argument("--pool", type=int, default=200, help="distinct synthetic crops")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--no-keepalive", action="store_true", help="new connection per request")
+    parser.add_argument("--json", help="also write all rows to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    pool = [synthetic_line(rng) for _ in range(args.pool)]
+
+    rows: List[dict] = []
+    if not args.spawn:
+        rows.extend(run_against(args.url, args, pool))
+    else:
+        port = urlparse(args.url).port or 8008
+        with tempfile.TemporaryDirectory(prefix="trocr-loadtest-") as state_dir:
+            for batch_size in args.batch_sizes:
+                if port_in_use(port):
+                    raise SystemExit(f"port {port} is already in use; pick another with --url")
+                proc = spawn_server(port, batch_size, args, state_dir)
+                try:
+                    rows.extend(run_against(f"http://127.0.0.1:{port}", args, pool, proc, batch_size))
+                finally:
+                    proc.terminate()
+                    proc.wait()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ import fs from "fs";
 import http from "http";
 import https from "https";
 import path from "path";
+import readline from "readline";
 import { URL } from "url";
 
 const pythonBin =
@@ -13,13 +14,27 @@ const pythonBin =
 
 const TROCR_URL = process.env.TROCR_URL || "http://127.0.0.1:8008/ocr";
 const TROCR_HEALTH_URL = process.env.TROCR_HEALTH_URL || "http://127.0.0.1:8008/health";
+// Shared across uploads so repeated scans and template pages skip OCR.
+const PAGE_INDEX_DIR = process.env.PAGE_INDEX_DIR || "cache/page_index";
+const STREAM_BATCH_SIZE = Number(process.env.TROCR_STREAM_BATCH || 16);
+
+// Pooled keep-alive connections to the TrOCR server; idle sockets are closed
+// a little before the server's own idle timeout.
+const agentOptions = {
+  keepAlive: true,
+  maxSockets: Number(process.env.TROCR_MAX_SOCKETS || 8),
+  timeout: Number(process.env.TROCR_SOCKET_IDLE_MS || 10000)
+};
+const httpAgent = new http.Agent(agentOptions);
+const httpsAgent = new https.Agent(agentOptions);
 
 let serverChecked = false;
 
 function httpRequest(url, method, payload) {
   return new Promise((resolve, reject) => {
     const urlObj = new URL(url);
-    const lib = urlObj.protocol === "https:" ? https : http;
+    const isHttps = urlObj.protocol === "https:";
+    const lib = isHttps ? https : http;
     const body = payload ? JSON.stringify(payload) : "";
 
     const req = lib.request(
@@ -28,18 +43,20 @@ function httpRequest(url, method, payload) {
         hostname: urlObj.hostname,
         port: urlObj.port,
         path: urlObj.pathname,
+        agent: isHttps ? httpsAgent : httpAgent,
         headers: {
           "Content-Type": "application/json",
           "Content-Length": Buffer.byteLength(body)
         }
       },
       res => {
-        let data = "";
+        const chunks = [];
         res.on("data", chunk => {
-          data += chunk.toString();
+          chunks.push(chunk);
         });
         res.on("end", () => {
           try {
+            const data = Buffer.concat(chunks).toString("utf-8");
             const parsed = data ? JSON.parse(data) : {};
             resolve({ status: res.statusCode || 0, data: parsed });
           } catch (err) {
@@ -65,21 +82,6 @@ async function ensureTrocrServer() {
   }
 }
 
-async function runTrOcrWithServer(linePaths) {
-  if (!linePaths || !linePaths.length) return "";
-
-  await ensureTrocrServer();
-
-  const response = await httpRequest(TROCR_URL, "POST", { paths: linePaths });
-  if (response.status !== 200) {
-    throw new Error(response.data?.error || "TrOCR server error");
-  }
-  if (response.data?.error) {
-    throw new Error(response.data.error);
-  }
-  return (response.data?.results || []).join("\n");
-}
-
 async function runTrOcrWithServerImages(images) {
   if (!images || !images.length) return "";
 
@@ -95,22 +97,89 @@ async function runTrOcrWithServerImages(images) {
   return (response.data?.results || []).join("\n");
 }
 
-function runTrOcr(linePaths) {
-  // Try server first, fallback to original method
-  return runTrOcrWithServer(linePaths).catch(err => {
-    console.error("Server method failed, using fallback:", err.message);
-    return runTrOcrFallback(linePaths);
+// Segments a page with lineSegment.py --ndjson and sends each batch of lines
+// to the TrOCR server as soon as it is cut, so OCR overlaps segmentation.
+// A batch the server rejects has only its own crops written to lineDir and
+// OCRed locally; other batches keep their server results. Resolves with the
+// line count, the joined text and whether every batch was recognized.
+function segmentAndOcrStreaming(pagePath, lineDir) {
+  return new Promise((resolve, reject) => {
+    const proc = spawn(
+      pythonBin,
+      ["python/lineSegment.py", pagePath, lineDir, "--ndjson"],
+      { stdio: ["ignore", "pipe", "pipe"] }
+    );
+
+    let lineCount = 0;
+    const pending = [];
+    let batch = [];
+    let failed = false;
+    let stderr = "";
+
+    const flush = () => {
+      if (!batch.length) return;
+      const images = batch;
+      const firstIndex = lineCount - images.length;
+      pending.push(
+        runTrOcrWithServerImages(images).catch(async err => {
+          console.error("OCR batch failed, using fallback:", err.message);
+          try {
+            return await runTrOcrFallback(writeTempImagesFromBase64(images, lineDir, firstIndex));
+          } catch (fallbackErr) {
+            console.error("Fallback OCR failed:", fallbackErr.message);
+            failed = true;
+            return null;
+          }
+        })
+      );
+      batch = [];
+    };
+
+    const timer = setTimeout(() => proc.kill(), 20000);
+
+    readline.createInterface({ input: proc.stdout }).on("line", line => {
+      if (!line.trim()) return;
+      try {
+        const record = JSON.parse(line);
+        batch.push(record.image);
+        lineCount += 1;
+      } catch (err) {
+        console.error("Line segmentation JSON parse failed:", err.message);
+        return;
+      }
+      if (batch.length >= STREAM_BATCH_SIZE) flush();
+    });
+
+    proc.stderr.on("data", chunk => {
+      stderr += chunk.toString();
+    });
+
+    proc.on("error", err => {
+      clearTimeout(timer);
+      reject(err);
+    });
+
+    proc.on("close", async code => {
+      clearTimeout(timer);
+      if (code !== 0) {
+        reject(new Error(stderr || `Line segmentation exited with ${code}`));
+        return;
+      }
+      flush();
+      const texts = await Promise.all(pending);
+      resolve({ lineCount, text: texts.filter(Boolean).join("\n"), complete: !failed });
+    });
   });
 }
 
-function writeTempImagesFromBase64(images, outputDir) {
+function writeTempImagesFromBase64(images, outputDir, firstIndex = 0) {
   if (!images || !images.length) return [];
   fs.mkdirSync(outputDir, { recursive: true });
   const paths = [];
 
   for (let i = 0; i < images.length; i += 1) {
     const buffer = Buffer.from(images[i], "base64");
-    const outPath = path.join(outputDir, `line_${i}.png`);
+    const outPath = path.join(outputDir, `line_${firstIndex + i}.png`);
     fs.writeFileSync(outPath, buffer);
     paths.push(outPath);
   }
@@ -151,6 +220,21 @@ function runTrOcrFallback(linePaths) {
   });
 }
 
+function recordPageText(entryPath, entryId, text) {
+  if (!entryPath || !entryId) return;
+  try {
+    const entry = JSON.parse(fs.readFileSync(entryPath, "utf-8"));
+    // The entry may have been evicted and rebuilt for another page meanwhile.
+    if (entry.id !== entryId) return;
+    entry.text = text;
+    const tmpPath = `${entryPath}.${process.pid}.tmp`;
+    fs.writeFileSync(tmpPath, JSON.stringify(entry));
+    fs.renameSync(tmpPath, entryPath);
+  } catch (err) {
+    console.error("Page index update failed:", err.message);
+  }
+}
+
 // No local server lifecycle management here; run the HTTP server separately.
 
 export default async function extractHandwrittenPdf(pdfPath) {
@@ -165,6 +249,7 @@ export default async function extractHandwrittenPdf(pdfPath) {
   fs.mkdirSync(pdfPagesDir, { recursive: true });
   fs.mkdirSync(lineDir, { recursive: true });
   fs.mkdirSync(diagramDir, { recursive: true });
+  fs.mkdirSync(PAGE_INDEX_DIR, { recursive: true });
 
   execSync(
     `pdftoppm "${pdfPath}" "${pdfPagesDir}/page" -png -r 250`,
@@ -184,16 +269,15 @@ export default async function extractHandwrittenPdf(pdfPath) {
     const pagePath = path.join(pdfPagesDir, page);
     console.log(`Processing: ${pagePath}`);
 
+    let pageEntry = null;
     try {
       const diagramOutput = execSync(
-        `"${pythonBin}" python/diagramDetect.py "${pagePath}" "${diagramDir}"`,
+        `"${pythonBin}" python/diagramDetect.py "${pagePath}" "${diagramDir}" --page-index "${PAGE_INDEX_DIR}"`,
         { encoding: "utf-8", timeout: 10000 }
       );
 
-      const diagramPaths = diagramOutput
-        .split("\n")
-        .map(l => l.trim())
-        .filter(Boolean);
+      pageEntry = JSON.parse(diagramOutput || "{}");
+      const diagramPaths = pageEntry.diagrams || [];
 
       if (diagramPaths.length > 0) {
         console.log(`Found ${diagramPaths.length} diagram(s)`);
@@ -203,43 +287,28 @@ export default async function extractHandwrittenPdf(pdfPath) {
 
     }
 
-    let output;
-    try {
-      output = execSync(
-        `"${pythonBin}" python/lineSegment.py "${pagePath}" "${lineDir}" --base64`,
-        { encoding: "utf-8", timeout: 20000, maxBuffer: 50 * 1024 * 1024 }
-      );
-    } catch (err) {
-      console.error("Line segmentation failed:", err.message);
+    if (pageEntry?.match && typeof pageEntry.text === "string") {
+      console.log("   Matched an indexed page, reusing its OCR text");
+      if (pageEntry.text) finalText += pageEntry.text + "\n";
+      finalText += "\n";
       continue;
     }
 
-    let images = [];
+    let lineCount = 0;
+    let pageText = "";
+    let complete = false;
     try {
-      const parsed = JSON.parse(output || "{}");
-      images = parsed.images || [];
+      ({ lineCount, text: pageText, complete } = await segmentAndOcrStreaming(pagePath, lineDir));
     } catch (err) {
-      console.error("Line segmentation JSON parse failed:", err.message);
-      images = [];
+      console.error("Line segmentation failed:", err.message);
+      continue;
     }
 
-    console.log(`   Found ${images.length} line segments`);
+    console.log(`   Found ${lineCount} line segments`);
 
-    if (images.length) {
-      try {
-        const text = await runTrOcrWithServerImages(images);
-        if (text) finalText += text + "\n";
-      } catch (err) {
-        console.error("OCR failed, using fallback:", err.message);
-        try {
-          const fallbackPaths = writeTempImagesFromBase64(images, lineDir);
-          const text = await runTrOcr(fallbackPaths);
-          if (text) finalText += text + "\n";
-        } catch (fallbackErr) {
-          console.error("Fallback OCR failed:", fallbackErr.message);
-        }
-      }
-    }
+    if (pageText) finalText += pageText + "\n";
+    // Partial text must not be reused for later matches of this page.
+    if (complete) recordPageText(pageEntry?.entry, pageEntry?.id, pageText);
 
     finalText += "\n";
   }